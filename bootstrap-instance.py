@@ -55,7 +55,11 @@ import boto
 import boto.utils
 from boto.s3.key import Key
 
-import simplejson as json
+# ujson parses user data fastest, otherwise the standard library's json will do
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 
 def main():
@@ -68,7 +72,7 @@ def main():
     # parse our userdata
     try:
         json_data = json.loads(user_data)
-    except json.decoder.JSONDecodeError, e:
+    except ValueError, e:
         print >>sys.stderr, "Couldn't parse JSON data:", e
         return 1
 
@@ -32,7 +32,8 @@
 #             "delete_on_terminate": "true"
 #         },
 #
-#         "services": ["cs_tomcat"]
+#         "services": ["cs_tomcat"],
+#         "parallel_services": "false"
 # }
 #
 # then the script will build an EBS volume, attach it to the instance,
@@ -59,27 +60,48 @@
 # the application volume can be configured as can any other file on the
 # filesystem.
 #
-# Finally, the script attempts to install and start application services.
-# If this succeeds, the EC2 instance has been bootstrapped.
+# Finally, the script attempts to install and start application services,
+# one after the other in the order given (or all at once if
+# 'parallel_services' is "true"). If this succeeds, the EC2 instance has
+# been bootstrapped.
 #
 
 
-import boto
-import boto.ec2
-import boto.utils
-from boto.s3.key import Key
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# we'd rather use pyahocorasick for placeholder substitution but can do without it
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 import re
 import sys
 import time
+import datetime
+import mmap
+import pipes
 import stat
+import collections
+import shutil
+import tempfile
 import os.path
-import urllib
 import subprocess
+import threading
+import urllib2
 import logging
-import fileinput
+import logging.handlers
+import multiprocessing
+import multiprocessing.util
 import ConfigParser
-import simplejson as json
+# ujson parses user data fastest, otherwise the standard library's json will do
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 
 
@@ -87,124 +109,286 @@ import simplejson as json
 AMI_FILELIST = 'bootstrap.filelist'
 # a template of properties to migrate
 AMI_PROPERTIES = 'bootstrap.properties'
+# records which bundle was last exploded alongside them
+BUNDLE_STAMP = 'bootstrap.bundle'
+# bundles are exploded somewhere only root can write to, as their files tell us what to rewrite
+BUNDLE_DIR = '/var/cache/ami-bootstrap'
 LOG_FILE = '/etc/ami-bootstrap.log'
+# the instance metadata service - we'd rather fail fast than hang if it's not there
+IMDS_URL = 'http://169.254.169.254/latest'
+IMDS_TIMEOUT = 2
+IMDS_TOKEN_TTL = '21600'
+# ...but it can be slow to answer early in boot, so give each request a few goes
+IMDS_RETRIES = 5
+# property values of this form are looked up in the instance's EC2 metadata
+EC2_METADATA_RE = re.compile(r'^ec2-metadata\.(.+)$')
+# boto named some instance attributes differently to boto3 - bundles written against the old
+# names map to an (attribute, item) pair, where item picks a single value out of a dict
+EC2_METADATA_ALIASES = {
+    'ip_address':        ('public_ip_address', None),
+    'dns_name':          ('public_dns_name', None),
+    'kernel':            ('kernel_id', None),
+    'ramdisk':           ('ramdisk_id', None),
+    'reason':            ('state_transition_reason', None),
+    'state':             ('state', 'Name'),
+    'state_code':        ('state', 'Code'),
+    'monitoring_state':  ('monitoring', 'State'),
+    'placement':         ('placement', 'AvailabilityZone'),
+    'placement_group':   ('placement', 'GroupName'),
+    'placement_tenancy': ('placement', 'Tenancy'),
+}
+# errors setting delete on terminate that mean the volume's attachment hasn't reached the
+# instance yet, rather than that it never will
+DELETE_ON_TERMINATE_RETRY_CODES = ('InvalidInstanceID.NotFound',
+                                   'InvalidInstanceAttributeValue',
+                                   'IncorrectInstanceState')
+# buffer size used when reading and writing bundle contents and migrated files
+IO_BUFSIZE = 1024 * 1024
+# bundles up to this size are held in memory rather than written to disk
+BUNDLE_SPOOL_SIZE = 64 * 1024 * 1024
+# all AWS clients retry throttled calls adaptively and share a pool of keep-alive connections
+AWS_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10},
+                    max_pool_connections=20)
+# bundles over 8MB are downloaded as concurrent 16MB ranged GETs, read off the wire in
+# IO_BUFSIZE chunks rather than the default 256KB
+BUNDLE_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                        multipart_chunksize=16 * 1024 * 1024,
+                                        max_concurrency=10,
+                                        io_chunksize=IO_BUFSIZE,
+                                        use_threads=True)
 
 # set up logging
 logger = logging.getLogger('ami-bootstrap')
 logger_file = logging.FileHandler(LOG_FILE)
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 logger_file.setFormatter(formatter)
-logger.addHandler(logger_file)
+# buffer records and write them out in batches - straight away if something goes wrong, at the
+# start of each stage of the bootstrap (see log_stage), and otherwise when the buffer fills up
+# or logging is shut down at exit
+logger_buffer = logging.handlers.MemoryHandler(1000, flushLevel=logging.ERROR, target=logger_file)
+logger.addHandler(logger_buffer)
 logger.setLevel(logging.DEBUG) 
 
 
+# log the start of a stage of the bootstrap and write out everything logged so far, so the log
+# shows how far we got even if the stage hangs
+def log_stage(message):
+    logger.info(message)
+    logger_buffer.flush()
+
+
 def main():
     # retrieve our user data JSON for the instance
     try:
         json_data = get_userdata_json()
-    except boto.exception.AWSConnectionError, e:
+    except IOError, e:
         print >>sys.stderr, "Couldn't connect to AWS to retrieve user data:", e
+        logger.error("Couldn't connect to AWS to retrieve user data: " + str(e))
         return 1
-    except json.decoder.JSONDecodeError, e:
+    except ValueError, e:
         print >>sys.stderr, "Couldn't parse JSON data:", e
+        logger.error("Couldn't parse JSON data: " + str(e))
         return 1
 
-    # get bucket_name and bundle_name from user data
-    if 'bootstrap' in json_data and 'bucket_name' in json_data['bootstrap']:
-        bucket_name = json_data['bootstrap']['bucket_name']
-    else:
-        return 1
-
-    if 'bootstrap' in json_data and 'bundle_name' in json_data['bootstrap']:
-        bundle_name = json_data['bootstrap']['bundle_name']
-    else:
+    # pull our configuration out of the bootstrap namespace
+    try:
+        bootstrap_config = get_bootstrap_config(json_data)
+    except ValueError, e:
+        print >>sys.stderr, "Invalid bootstrap config:", e
+        logger.error("Invalid bootstrap config: " + str(e))
         return 1
 
-    #instance_id = urllib.urlopen("http://169.254.169.254/latest/meta-data/instance-id").read()
     instance_id = os.environ['INSTANCE_ID']
     region = os.environ['AWS_REGION']
     zone   = os.environ['AWS_AZ']
-    ec2    = boto.ec2.connect_to_region(region)
 
     if not instance_id or not region or not zone:
         raise Exception("Couldn't retrieve environment information. Can't continue bootstrapping.")
 
+    # a single session for the whole run, so each service's connections are reused from call
+    # to call - EC2 is used through its resource interface so instance attributes keep the
+    # snake_case names (private_ip_address etc.) that ec2-metadata properties refer to, and
+    # boto's old names are aliased (see EC2_METADATA_ALIASES)
+    session = boto3.Session(region_name=region)
+    ec2     = session.resource('ec2', config=AWS_CONFIG)
+    s3      = session.client('s3', config=AWS_CONFIG)
+
+    log_stage("Retrieving bundle from S3")
+    # retrieve bootstrapping bundle from S3 and explode it (returns the exploded path) - in the
+    # background, as it doesn't depend on anything else we do before bootstrapping
+    wait_for_bundle = in_background(fetch_and_extract_bundle, s3, bootstrap_config.bucket_name,
+                                    bootstrap_config.bundle_name, BUNDLE_DIR)
+
     # create and attach app volume if supplied
-    if 'app_vol' in json_data['bootstrap']:
-        print "Creating an attaching app volume from snapshot"
-        app_vol = json_data['bootstrap']['app_vol']
-        vol_created = create_attach_app_vol(ec2, instance_id, region, zone, app_vol)
-
-    print "Retrieving bundle from S3"
-    # retrieve bootstrapping bundle from S3 (returns a file path)
-    bundle_path = get_bundle(bucket_name, bundle_name, '/tmp')
-
-    # explode it
-    if os.path.exists(bundle_path):
-        print "Exploding bundle"
-        exploded_bundle_path = explode_bundle(bundle_path)
-    else:
-        raise Exception("Didn't save bootstrapping bundle to: " + bundle_path)
+    if bootstrap_config.app_vol is not None:
+        log_stage("Creating an attaching app volume from snapshot")
+        vol_created = create_attach_app_vol(ec2, instance_id, zone, bootstrap_config.app_vol)
+
+    # let's get a handle on the current instance so we can retrieve metadata during bootstrap -
+    # its attributes are all loaded by a single describe call, made while the bundle downloads
+    instance = ec2.Instance(instance_id)
+    instance.load()
+
+    log_stage("Waiting for bundle")
+    exploded_bundle_path = wait_for_bundle()
 
     # bootstrap!
-    print "Bootstrapping!"
-    bootstrap(ec2, instance_id, exploded_bundle_path)
+    log_stage("Bootstrapping!")
+    bootstrap(instance, exploded_bundle_path)
 
     # set metadata iff it was supplied in user data
-    if 'bootstrap' in json_data and 'metadata' in json_data['bootstrap']:
-        metadata = json_data['bootstrap']['metadata']
-        print "Setting metadata on instance and volumes"
-        set_metadata(ec2, instance_id, zone, metadata)
+    if bootstrap_config.metadata is not None:
+        log_stage("Setting metadata on instance and volumes")
+        set_metadata(ec2, instance_id, zone, bootstrap_config.metadata)
 
     # start the application service(s) if required
-    if 'bootstrap' in json_data and 'services' in json_data['bootstrap']:
-        services = json_data['bootstrap']['services']
-        print "Enabling and starting services"
-        start_services(services)
+    if bootstrap_config.services is not None:
+        log_stage("Enabling and starting services")
+        start_services(bootstrap_config.services, bootstrap_config.parallel_services in (True, 'true'))
+
+
+# run a function on a background thread - returns a function that waits for the thread to
+# finish and returns whatever the function returned (or raises whatever it raised)
+def in_background(function, *args):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = function(*args)
+        except:
+            outcome['error'] = sys.exc_info()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        if 'error' in outcome:
+            error_type, error, traceback = outcome['error']
+            raise error_type, error, traceback
+        return outcome['result']
+
+    return wait
+
+
+# download a "bootstrapping bundle" from S3 and explode it into a directory - the bundle is
+# only spooled to disk if it's too big to comfortably hold in memory
+#
+# if the same version of the same bundle (going by its bucket, key and ETag) was the last one
+# exploded there, e.g. by a retry, the download is skipped altogether
+def fetch_and_extract_bundle(s3, bucket_name, bundle_name, to_path):
+    etag = s3.head_object(Bucket=bucket_name, Key=bundle_name)['ETag']
+    # the stamp is kept as UTF-8, whatever mix of byte and unicode strings we're given
+    stamp = [value if isinstance(value, unicode) else value.decode('utf-8')
+             for value in (bucket_name, bundle_name, etag)]
+    stamp_file = os.path.join(to_path, BUNDLE_STAMP)
+
+    make_private_dir(to_path)
+
+    if read_bundle_stamp(stamp_file, to_path) == stamp:
+        logger.info("Bundle unchanged since it was last exploded, skipping download")
+        return to_path
+
+    # every bundle explodes into the same files, so forget the last one before we overwrite them
+    if os.path.exists(stamp_file):
+        os.remove(stamp_file)
+
+    bundle_fh = tempfile.SpooledTemporaryFile(max_size=BUNDLE_SPOOL_SIZE, dir=to_path)
+    try:
+        get_bundle(s3, bucket_name, bundle_name, bundle_fh)
+
+        logger.info("Exploding bundle")
+        bundle_fh.seek(0)
+        exploded_path = explode_bundle(bundle_fh, to_path)
+    finally:
+        bundle_fh.close()
+
+    # only record the bundle once it has been completely exploded
+    with open(stamp_file, 'w') as fh:
+        fh.write('\n'.join(stamp).encode('utf-8'))
+
+    return exploded_path
+
+
+# get the bucket, key and ETag of the bundle last exploded into a directory, if its
+# bootstrapping files are still there
+def read_bundle_stamp(stamp_file, exploded_path):
+    for file in (stamp_file,
+                 os.path.join(exploded_path, AMI_PROPERTIES),
+                 os.path.join(exploded_path, AMI_FILELIST)):
+        if not os.path.exists(file):
+            return None
+
+    with open(stamp_file, 'r') as fh:
+        return fh.read().decode('utf-8').split('\n')
 
 
-# download a "bootstrapping bundle" from S3
-def get_bundle(bucket_name, bundle_name, to_path):
-    local_bundle_path = os.path.join(to_path, bundle_name)
+# make sure a directory exists and only we can get at it - we won't use one anybody else owns
+# or can write to
+def make_private_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, stat.S_IRWXU)
 
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode) or path_stat.st_uid != os.getuid():
+        raise Exception("Not using a directory we don't own: " + path)
+    if stat.S_IMODE(path_stat.st_mode) != stat.S_IRWXU:
+        os.chmod(path, stat.S_IRWXU)
+
+
+# download a "bootstrapping bundle" from S3 into a file object
+def get_bundle(s3, bucket_name, bundle_name, bundle_fh):
+    # large bundles are fetched as concurrent ranged GETs rather than one sequential GET
     try:
-        s3_conn = boto.connect_s3()
-        bucket = s3_conn.get_bucket(bucket_name)
+        s3.download_fileobj(bucket_name, bundle_name, bundle_fh, Config=BUNDLE_TRANSFER_CONFIG)
     except Exception, e:
         print >>sys.stderr, "Exception:", e
         raise
-    else:
-        k = Key(bucket)
-        k.key = bundle_name
-        k.get_contents_to_filename(local_bundle_path)
 
-    return local_bundle_path
-
-
-# expand bootstrapping bundle
-def explode_bundle(bundle_path):
-    exploded_path = os.path.dirname(bundle_path)
 
+# expand bootstrapping bundle (a path or file object) into a directory
+def explode_bundle(bundle, exploded_path):
     # we support zip files - that's it :)
     import zipfile
 
-    if not zipfile.is_zipfile(bundle_path):
-        raise Exception("Unsupported bundle type: " + ext)
+    # opening the archive reads its central directory, which is all the checking we need
+    try:
+        archive = zipfile.ZipFile(bundle, 'r')
+    except zipfile.BadZipfile, e:
+        raise Exception("Unsupported bundle type: " + str(e))
+
+    # stream each member out to disk rather than reading it all into memory first - infolist
+    # gives us each member's size up front, so small members get a buffer to match
+    for info in archive.infolist():
+        exploded_file = os.path.join(exploded_path, info.filename)
+
+        # directory entries only need creating
+        if info.filename.endswith('/'):
+            if not os.path.isdir(exploded_file):
+                os.makedirs(exploded_file)
+            continue
+
+        exploded_dir = os.path.dirname(exploded_file)
+        if not os.path.isdir(exploded_dir):
+            os.makedirs(exploded_dir)
 
-    archive = zipfile.ZipFile(bundle_path, 'r')
+        with open(exploded_file, 'wb') as exploded_fh:
+            # empty members have nothing to copy
+            if info.file_size == 0:
+                continue
 
-    # there is no extract or extractall in python 2.5 :(
-    for file in archive.namelist():
-        exploded_file = os.path.join(exploded_path, file)
-        exploded_fh = open(exploded_file, 'w')
-        exploded_fh.write(archive.read(file))
+            with archive.open(info) as member_fh:
+                shutil.copyfileobj(member_fh, exploded_fh, min(info.file_size, IO_BUFSIZE))
+
+    archive.close()
 
     return exploded_path
 
 
 # run the bootstrapping logic
-def bootstrap(ec2, instance_id, bundle_path):
-    print "Ready to run bootstrap using extracted bundle in: " + bundle_path
+def bootstrap(instance, bundle_path):
+    logger.info("Ready to run bootstrap using extracted bundle in: " + bundle_path)
 
     properties_file = os.path.join(bundle_path, AMI_PROPERTIES)
     filelist_file   = os.path.join(bundle_path, AMI_FILELIST)
@@ -214,25 +398,63 @@ def bootstrap(ec2, instance_id, bundle_path):
     config.optionxform = str
     config.read(properties_file)
 
+    # build a single matcher over all placeholders so each file is only scanned once
+    matcher = build_matcher(resolve_placeholders(instance, config.items('host_config')))
 
-    # let's get a handle on the current instance so we can retrieve metadata during bootstrap
-    # yes - boto really makes you get the first element in the result set, and then use the first
-    # element in the instances list for that, to get at the instance :S
-    instance = ec2.get_all_instances(instance_id)[0].instances[0]
+    # loop through ami filelist applying filters/patches to it - each file is independent
+    # of the others, so spread them across a pool of worker processes
+    with open(filelist_file, 'r') as filelist_fh:
+        files = filelist_fh.read().splitlines()
+    files = [file for file in files if os.path.exists(file)]
 
-    # loop through ami filelist applying filters/patches to it
-    for file in open(filelist_file, 'r'):
-        file = file.rstrip('\n')
-        if os.path.exists(file):
-            migrate_file(instance, config, file)
+    # a single file isn't worth forking workers for
+    if len(files) <= 1:
+        for file in files:
+            migrate_file(matcher, file)
+        return
 
+    # write out anything buffered so far, otherwise each worker would inherit a copy of it
+    logger_buffer.flush()
+
+    # hand out files one at a time - filelists are short, so batching them up would leave most
+    # of the workers idle
+    pool = multiprocessing.Pool(min(len(files), multiprocessing.cpu_count()),
+                                initializer=init_migrate_worker, initargs=(matcher,))
+    try:
+        for file in pool.imap_unordered(migrate_worker, files, 1):
+            pass
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# the matcher used by a migrate worker process - it's handed over once when the worker
+# starts rather than being pickled along with every file
+migrate_matcher = None
+
+
+def init_migrate_worker(matcher):
+    global migrate_matcher
+    migrate_matcher = matcher
+
+    # workers exit without shutting down logging, so write out their buffered records as
+    # they finish
+    multiprocessing.util.Finalize(None, logger_buffer.flush, exitpriority=10)
+
+
+def migrate_worker(file):
+    migrate_file(migrate_matcher, file)
+    return file
 
-# migrate a file
-def migrate_file(instance, config, file):
-    logger.info(file)
 
-    # open file and do an inplace search and replace for each key/value pair
-    for line in fileinput.FileInput(file, inplace=1):
+# resolve the value for each placeholder, returning a list of (placeholder, value) pairs
+def resolve_placeholders(instance, items):
+    placeholders = []
+
+    for key, value in items:
 
         # N.B. if the value for a key matches ec2-metadata.(.*) then we retrieve the value
         # by looking up the instance metadata value using whatever is captured in the regex as
@@ -240,42 +462,203 @@ def migrate_file(instance, config, file):
         #
         # i.e. we use getattr to get an attribute of that name from our instance object
         #
-        for key, value in config.items('host_config'):
+        m = EC2_METADATA_RE.search(value)
+        if m and m.group(1):
+            instance_metadata_key = m.group(1)
+            attribute, item = EC2_METADATA_ALIASES.get(instance_metadata_key, (instance_metadata_key, None))
+            instance_metadata_value = getattr(instance, attribute)
+            if instance_metadata_value is not None and item is not None:
+                instance_metadata_value = instance_metadata_value.get(item)
+            if instance_metadata_value is not None:
+                value = instance_metadata_value
+            else:
+                raise Exception("Couldn't retrieve EC2 instance metadata for key: " + key)
+
+        # boto3 hands back metadata as unicode, but files are migrated as byte strings - encode
+        # values up front rather than have every file implicitly decoded as ascii on the join
+        #
+        # numbers, flags and times are written out as strings, but anything else (a dict, a
+        # list...) would only be substituted as its repr, so refuse it
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, (bool, int, long, float)):
+            value = str(value)
+        elif not isinstance(value, str):
+            raise Exception("EC2 instance metadata for key " + key + " isn't a string: " + repr(value))
+
+        placeholders.append((key, value))
+
+    return placeholders
+
+
+# build a matcher that finds all placeholders in a single pass - an Aho-Corasick automaton
+# if pyahocorasick is installed, otherwise a compiled regex alternation of the placeholders
+def build_matcher(placeholders):
+    if not placeholders:
+        return None
+
+    if ahocorasick:
+        automaton = ahocorasick.Automaton()
+        for key, value in placeholders:
+            automaton.add_word(key, (key, value))
+        automaton.make_automaton()
+
+        return automaton
+
+    # longest placeholders go first so none is shadowed by another it starts with
+    keys = sorted([key for key, value in placeholders], key=len, reverse=True)
+    pattern = re.compile('|'.join([re.escape(key) for key in keys]))
+
+    return pattern, dict(placeholders)
+
+
+# find all placeholders in some data as (start, -length, placeholder, value) tuples
+def find_placeholders(matcher, data):
+    if ahocorasick:
+        return [(end - len(key) + 1, -len(key), key, value)
+                for end, (key, value) in matcher.iter(data)]
+
+    pattern, values = matcher
+    return [(m.start(), -len(m.group()), m.group(), values[m.group()])
+            for m in pattern.finditer(data)]
 
-            m = re.search('^ec2\-metadata\.(.+)$', value)
-            if m and m.group(1):
-                instance_metadata_key = m.group(1)
-                instance_metadata_value = getattr(instance, instance_metadata_key)
-                if instance_metadata_value:
-                    value = instance_metadata_value
-                else:
-                    raise Exception("Couldn't retrieve EC2 instance metadata for key: " + key)
 
-            if key in line:
-                logger.debug('Replacing ' + key + ' with ' + value + ' in line: ' + line)
-                line = line.replace(key, value)
+# replace all placeholders found in some data in a single pass - where matches overlap, the
+# leftmost (and then longest) placeholder wins
+#
+# returns the new data and the number of placeholders replaced
+def replace_placeholders(matcher, data):
+    if matcher is None:
+        return data, 0
+
+    matches = find_placeholders(matcher, data)
+    if not matches:
+        return data, 0
+    matches.sort()
+
+    # don't bother building debug messages unless they'll be logged
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    pieces = []
+    pos = 0
+    replaced = 0
+    for start, length, key, value in matches:
+        # skip matches overlapping a placeholder we've already replaced
+        if start < pos:
+            continue
+
+        if debug:
+            line_start = data.rfind('\n', 0, start) + 1
+            line_end = data.find('\n', start)
+            if line_end == -1:
+                line_end = len(data)
+            logger.debug('Replacing ' + key + ' with ' + value + ' in line: ' + data[line_start:line_end])
+
+        pieces.append(data[pos:start])
+        pieces.append(value)
+        pos = start + len(key)
+        replaced += 1
+
+    pieces.append(data[pos:])
 
-        print line,
+    return ''.join(pieces), replaced
 
 
-# configure and start all required services
-def start_services(services):
+# migrate a file
+def migrate_file(matcher, file):
+    logger.info(file)
+
+    # replace all placeholders in the whole file in one go - the regex matcher can scan a
+    # memory map of the file in place, so the file is only copied into memory as pieces of
+    # the new data, but pyahocorasick only scans strings so read the file for that
+    with open(file, 'rb', IO_BUFSIZE) as fh:
+        if ahocorasick or os.fstat(fh.fileno()).st_size == 0:
+            data, replaced = replace_placeholders(matcher, fh.read())
+        else:
+            file_map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data, replaced = replace_placeholders(matcher, file_map)
+            finally:
+                file_map.close()
+
+    # leave files without any placeholders alone
+    if not replaced:
+        return
+
+    # write to a temporary file alongside the original and rename it into place, so the
+    # file is never left half written - keeping the original's permissions and ownership
+    file_stat = os.stat(file)
+    tmp_fh = tempfile.NamedTemporaryFile(bufsize=IO_BUFSIZE, dir=os.path.dirname(file), delete=False)
+    try:
+        with tmp_fh:
+            tmp_fh.write(data)
+        shutil.copystat(file, tmp_fh.name)
+        os.chown(tmp_fh.name, file_stat.st_uid, file_stat.st_gid)
+        os.rename(tmp_fh.name, file)
+    except:
+        os.remove(tmp_fh.name)
+        raise
+
+
+# configure and start all required services - in order, each one started before the next
+# unless they can all be started at once
+def start_services(services, parallel=False):
+    # init scripts get the same scrubbed environment service would give them, so things like
+    # our AWS credentials don't leak into the services
+    service_env = {'PATH': '/sbin:/usr/sbin:/bin:/usr/bin'}
+    for name in ('LANG', 'TERM'):
+        if name in os.environ:
+            service_env[name] = os.environ[name]
+
+    # ensure we can run them - set perms to 755 (unless they're already set)
+    script_perm = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+    for service in services:
+        service_script = os.path.normpath(os.path.join('/etc', 'init.d', service))
+        if stat.S_IMODE(os.stat(service_script).st_mode) != script_perm:
+            os.chmod(service_script, script_perm)
+
+    if services and os.path.exists('/run/systemd/system'):
+        # systemd only generates units for init scripts that were there and executable when it
+        # last looked - since then we may have made them executable, or mounted the volume they
+        # live on - so have it look again
+        subprocess.check_call(['systemctl', 'daemon-reload'], cwd='/', env=service_env)
+
+        # systemd can turn all of the services "on" and start them in a single call, but then
+        # makes no promises about the order they start in
+        if parallel:
+            subprocess.check_call(['systemctl', 'enable', '--now'] + list(services), cwd='/', env=service_env)
+        else:
+            for service in services:
+                subprocess.check_call(['systemctl', 'enable', '--now', service], cwd='/', env=service_env)
+        return
+
+    procs = []
     for service in services:
-        # ensure we can run it - set perms to 755
         service_script = os.path.normpath(os.path.join('/etc', 'init.d', service))
-        script_perm = stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
-        os.chmod(service_script, script_perm)
-
-        # turn the service "on" with chkconfig
-        retcode = subprocess.call(['chkconfig', service, 'on'])
-        retcode = subprocess.call(['chkconfig', service, 'reset'])
 
-        # run it!
-        retcode = subprocess.call(['service', service, 'start'])
+        # turn the service "on" with chkconfig and run it! - all in one shell so it's a single
+        # fork per service
+        #
+        # the init script is run directly, saving the fork of service itself
+        command = 'chkconfig %(service)s on && chkconfig %(service)s reset && %(script)s start'
+        command = command % {'service': pipes.quote(service), 'script': pipes.quote(service_script)}
+        proc = subprocess.Popen(['sh', '-c', command], cwd='/', env=service_env)
+        procs.append((service, proc))
+
+        # a service may depend on the ones before it, so unless they can all start at once
+        # wait for it - and don't start any more if it failed
+        if not parallel and proc.wait() != 0:
+            break
 
-        if retcode != 0:
-            print >>sys.stderr, "Starting " + service + " returned a non-zero exit code"
-            raise OSError(retcode, "Starting " + service + " returned non-zero exit code")
+    # wait for every service we started, even if one has already failed, before reporting failures
+    failed = [(service, proc.wait()) for service, proc in procs]
+    failed = [(service, retcode) for service, retcode in failed if retcode != 0]
+    if failed:
+        service, retcode = failed[0]
+        print >>sys.stderr, "Starting " + ', '.join([f[0] for f in failed]) + " returned a non-zero exit code"
+        raise OSError(retcode, "Starting " + service + " returned non-zero exit code")
 
 
 # set instance metadata - that's all we support anyway
@@ -288,25 +671,62 @@ def set_metadata(ec2, instance_id, zone, metadata):
         if 'Name' in instance_metadata and zone != '':
             instance_metadata['Name'] += ' - ' + zone
 
-        if not ec2.create_tags(resources, instance_metadata):
-            print >> sys.stderr, "Couldn't tag instance: " + instance_id
-            raise Exception("Couldn't tag instance: " + instance_id);
-
-        # this doesn't seem inefficient - should be a way to query instance volumes directly
-        volumes = [v.id for v in ec2.get_all_volumes() if v.attach_data.instance_id == instance_id]
-
         # metadata keys are case-sensitive - we assume that if the user wants to tag the name
         # of assets, they've used 'Name' because that's the only one that works
-        if 'Name' in instance_metadata:
-            if not ec2.create_tags(volumes, {'Name': instance_metadata['Name']}):
-                print >> sys.stderr, "Couldn't tag volumes with instance name: " + instance_metadata['Name']
-                raise Exception("Couldn't tag volumes with instance name: " + instance_metadata['Name']);
+        #
+        # the name goes on the instance and its volumes in a single call, any other tags only
+        # go on the instance
+        instance_tags = dict(instance_metadata)
+        if 'Name' in instance_tags:
+            name = instance_tags.pop('Name')
+
+            # only ask EC2 for the volumes attached to this instance, not every volume in the region
+            volume_filter = {'Name': 'attachment.instance-id', 'Values': [instance_id]}
+            volumes = [v.id for v in ec2.volumes.filter(Filters=[volume_filter])]
+
+            try:
+                ec2.create_tags(Resources=resources + volumes, Tags=[{'Key': 'Name', 'Value': name}])
+            except ClientError, e:
+                print >> sys.stderr, "Couldn't tag instance and volumes with instance name: " + name
+                raise
+
+        if instance_tags:
+            try:
+                ec2.create_tags(Resources=resources,
+                                Tags=[{'Key': k, 'Value': v} for k, v in instance_tags.items()])
+            except ClientError, e:
+                print >> sys.stderr, "Couldn't tag instance: " + instance_id
+                raise
+
+
+# talk to the instance metadata service directly, never through a proxy
+imds_opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+
+# make a request of the instance metadata service, retrying with a short backoff if it times
+# out or fails - returns the response body
+def imds_request(request):
+    for retries in range(0, IMDS_RETRIES):
+        try:
+            return imds_opener.open(request, timeout=IMDS_TIMEOUT).read()
+        except IOError, e:
+            if retries == IMDS_RETRIES - 1:
+                raise
+            logger.warning("Instance metadata request failed, retrying: " + str(e))
+            time.sleep(0.5 * 2 ** retries)
 
 
 # get user data which is assumed to be JSON, parse it and return a JSON object
 def get_userdata_json():
-    # get user data
-    user_data = boto.utils.get_instance_userdata()
+    # get an IMDSv2 session token, then use it to get user data
+    token_request = urllib2.Request(IMDS_URL + '/api/token',
+                                    headers={'X-aws-ec2-metadata-token-ttl-seconds': IMDS_TOKEN_TTL})
+    token_request.get_method = lambda: 'PUT'
+    token = imds_request(token_request)
+
+    user_data_request = urllib2.Request(IMDS_URL + '/user-data',
+                                        headers={'X-aws-ec2-metadata-token': token})
+    user_data = imds_request(user_data_request)
 
     # parse our userdata - to make sure it's valid JSON (this will throw exceptions otherwise)
     json_data = json.loads(user_data)
@@ -314,7 +734,26 @@ def get_userdata_json():
     return json_data
 
 
-def create_attach_app_vol(ec2, instance_id, region, zone, app_vol):
+# the parts of the bootstrap user data namespace this script uses - other scripts keep their
+# own configuration in the same namespace, so anything else there is ignored
+BootstrapConfig = collections.namedtuple('BootstrapConfig',
+                                         'bucket_name bundle_name metadata app_vol services '
+                                         'parallel_services')
+
+
+# get our configuration from user data - bucket_name and bundle_name are required, anything
+# else is optional and defaults to None
+def get_bootstrap_config(json_data):
+    bootstrap_config = json_data.get('bootstrap') or {}
+
+    missing = [field for field in ('bucket_name', 'bundle_name') if not bootstrap_config.get(field)]
+    if missing:
+        raise ValueError("Missing required bootstrap config: " + ', '.join(missing))
+
+    return BootstrapConfig(*[bootstrap_config.get(field) for field in BootstrapConfig._fields])
+
+
+def create_attach_app_vol(ec2, instance_id, zone, app_vol):
     # check that we have enough information to continue
     if 'dev_name' in app_vol and 'mount_point' in app_vol and 'snapshot_id' in app_vol and 'vol_size' in app_vol:
         dev_name    = app_vol['dev_name']
@@ -324,53 +763,69 @@ def create_attach_app_vol(ec2, instance_id, region, zone, app_vol):
     else:
         raise Exception("Not enough information to create application volume");
 
-    if 'delete_on_terminate' in app_vol:
-        delete_on_terminate = app_vol['delete_on_terminate']
+    delete_on_terminate = app_vol.get('delete_on_terminate')
 
     # TODO: check that we don't already have a volume created and attached
 
     # create a volume based off the snapshot and attach it
-    print "   creating volume..."
-    vol = ec2.create_volume(vol_size, zone, snapshot_id)
-    print "   attaching volume..."
-    vol.attach(instance_id, dev_name)
+    logger.info("Creating volume...")
+    vol = ec2.create_volume(Size=vol_size, AvailabilityZone=zone, SnapshotId=snapshot_id)
+    logger.info("Attaching volume...")
+    vol.attach_to_instance(InstanceId=instance_id, Device=dev_name)
+
+    # wait for EC2 to report the volume as attached rather than sleeping a fixed amount - for
+    # up to 30s, as attaching can take a while at boot
+    for retries in range(0, 60):
+        vol.reload()
+        if vol.attachments and vol.attachments[0]['State'] == 'attached':
+            break
+        time.sleep(0.5)
+    else:
+        raise Exception("Timed out waiting for app volume to attach: " + vol.id)
 
-    # try up to 5 times to mount (giving the attach time to finish)
+    # EC2 can report the volume as attached before the kernel has created its device, so give
+    # mount a few goes
+    logger.info("Mounting...")
     for retries in range(0, 5):
-        # give the attach time to finish
-        time.sleep(5)
-
-        print "Trying to mount..."
-        # mount the volume and break if we're successful
-        retcode = subprocess.call(['mount', mount_point])
-        if retcode == 0:
+        try:
+            subprocess.check_call(['mount', mount_point])
             break
+        except subprocess.CalledProcessError:
+            if retries == 4:
+                raise
+            time.sleep(0.5)
 
-    print "Mounted app volume successfully"
+    logger.info("Mounted app volume successfully")
 
-    # set volume to delete when we terminate the instance
-    # run something like:
-    #   ec2-modify-instance-attribute --region us-west-1 --block-device-mapping /dev/sdi=:true i-dba8139c
+    # set volume to delete when we terminate the instance - the new attachment can take a
+    # moment to show up in the instance's block device mapping, so retry with a short backoff
+    # while EC2 says it isn't there yet
     if delete_on_terminate == 'true':
-        print "Setting delete on terminate"
-
-        # a vain attempt to make sure we can change the instance attribute to delete our app volume
-        # on termination of the instance
-        time.sleep(10)
-
-        retcode = subprocess.call(['ec2-modify-instance-attribute',
-                                   '--region', region,
-                                   '--block-device-mapping', dev_name + '=:true',
-                                   instance_id])
-
-        # FIXME: changing this attribute at boot time doesn't work at the moment
-        #if retcode != 0:
-        #    raise Exception("Couldn't set delete on terminate attribute for app volume", retcode)
+        logger.info("Setting delete on terminate")
+
+        for retries in range(0, 5):
+            try:
+                ec2.meta.client.modify_instance_attribute(
+                    InstanceId=instance_id,
+                    BlockDeviceMappings=[{'DeviceName': dev_name, 'Ebs': {'DeleteOnTermination': True}}])
+                break
+            except ClientError, e:
+                if e.response['Error']['Code'] not in DELETE_ON_TERMINATE_RETRY_CODES or retries == 4:
+                    # N.B. this has never been reliable at boot time, so don't fail the bootstrap over it
+                    print >>sys.stderr, "Couldn't set delete on terminate attribute for app volume:", e
+                    logger.error("Couldn't set delete on terminate attribute for app volume: " + str(e))
+                    break
+                time.sleep(0.1 * 2 ** retries)
 
     #TODO: check that we have an attached volume correctly
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    # anything that stops the bootstrap goes in the log as well as on stderr
+    try:
+        sys.exit(main())
+    except Exception:
+        logger.exception("Bootstrapping failed")
+        raise
 
 